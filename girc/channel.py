@@ -1,8 +1,8 @@
 
 import gevent
+import gevent.event
 
 from girc.message import Join, Part, Privmsg
-from girc.replycodes import replies
 from girc.userlist import UserList
 
 
@@ -13,7 +13,7 @@ class Channel(object):
 	Note that you should use client.channel() to get a channel object, not Channel().
 
 	A channel may be join()ed and part()ed multiple times.
-	The user list will be the most recent info available.
+	While joined, users is the most recent info available on the channel's users (it is None when parted).
 	In particular, the user list can be considered up to date iff users_ready is set.
 
 	Can be used in a with statement to join then part.
@@ -21,16 +21,15 @@ class Channel(object):
 
 	USERS_READY_TIMEOUT = 10
 
-	joined = False
-	users = None
+	__slots__ = ('client', 'name', 'joined', 'users', 'users_ready')
 
 	def __init__(self, client, name):
 		self.client = client
+		self.joined = False
+		self.users = None
 		self.users_ready = gevent.event.Event()
 		self.name = client.normalize_channel(name)
-		self.client._channels[self.name] = self
-		self.client.handler(self._recv_part, command=Part, channels=lambda value: self.name in value, sync=True)
-		self.client.handler(self._recv_end_of_names, command=replies.ENDOFNAMES, params=[None, self.name, None], sync=True)
+		self.client._channels[self.name] = self # client will pass relevant messages to our _recv_* methods
 
 	def join(self, block=False):
 		"""Join the channel if not already joined. If block=True, do not return until name list is received."""
@@ -45,18 +44,24 @@ class Channel(object):
 		but does not actually join the channel. It is intended for use when the server automatically
 		joins the client to a channel."""
 		self.joined = True
+		self.users_ready.clear()
 		self.users = UserList(self.client, self.name)
 
 	def part(self, block=False):
 		"""Part from the channel if joined. If block=True, do not return until fully parted."""
 		if not self.joined: return
 		self.joined = False
+		# we may have re-joined (with a new user list) by the time the part is sent
+		users = self.users
 		@gevent.spawn
 		def _part():
 			# we delay unregistering until the part is sent.
 			Part(self.client, self.name).send(block=True)
-			self.users_ready.clear()
-			self.users.unregister()
+			if users is not None:
+				users.unregister()
+			if self.users is users:
+				self.users_ready.clear()
+				self.users = None
 		if block: _part.get()
 
 	def msg(self, content, block=False):
@@ -69,9 +74,14 @@ class Channel(object):
 		self.users_ready.set()
 
 	def _recv_part(self, client, msg):
-		# we receive a forced PART from the server
+		# we receive a forced PART from the server, or the server is confirming our own part()
+		if not self.joined:
+			return # part() has already cleaned up
 		self.joined = False
-		self.users.unregister()
+		self.users_ready.clear()
+		if self.users is not None:
+			self.users.unregister()
+			self.users = None
 
 	def __enter__(self):
 		self.join()
@@ -1,7 +1,8 @@
 
 """A queue which supports low-cardinality priorities, with FIFO within each priority level"""
 
-from collections import defaultdict, deque
+from bisect import insort
+from collections import deque
 
 import gevent.queue
 
@@ -22,7 +23,8 @@ class ChunkedPriorityQueue(gevent.queue.Queue):
 	A global limit outside any context manager is also able to be set with queue.set_limit()
 	"""
 
-	# Implementation: self.queue is a dict {priority: deque}
+	# Implementation: self.queue is a dict {priority: deque}, and self._priorities is a sorted list of its keys.
+	# self._size is the total number of items, and self.limit caches the result of get_limit().
 
 	limit = None
 	DUMMY = object()
@@ -37,34 +39,48 @@ class ChunkedPriorityQueue(gevent.queue.Queue):
 		self._limits = {}
 
 	def _create_queue(self, items=()):
-		queue = defaultdict(deque)
+		queue = {}
+		self._priorities = []
+		self._size = 0
 		for item in items:
 			priority, data = item
-			self.queue[priority].append(data)
+			if priority not in queue:
+				queue[priority] = deque()
+				insort(self._priorities, priority)
+			queue[priority].append(data)
+			self._size += 1
 		return queue
 
 	def qsize(self):
-		limit = self.get_limit()
-		return sum(len(queue) for priority, queue in self.queue.items()
-				   if limit is None or priority <= limit)
+		limit = self.limit
+		if limit is None:
+			return self._size
+		return sum(len(self.queue[priority]) for priority in self._priorities if priority <= limit)
 
 	def _put(self, item):
 		if item is self.DUMMY:
 			return
 		priority, data = item
-		self.queue[priority].append(data)
+		queue = self.queue.get(priority)
+		if queue is None:
+			queue = self.queue[priority] = deque()
+			insort(self._priorities, priority)
+		queue.append(data)
+		self._size += 1
 
 	def _find_next(self):
-		limit = self.get_limit()
-		for priority, queue in sorted(self.queue.items()):
+		limit = self.limit
+		for priority in self._priorities:
 			if limit is not None and priority > limit:
 				break
+			queue = self.queue[priority]
 			if queue:
 				return priority, queue
 		assert False, "_find_next called with all queues empty"
 
 	def _get(self):
 		priority, queue = self._find_next()
+		self._size -= 1
 		return priority, queue.popleft()
 
 	def _peek(self):
@@ -72,7 +88,10 @@ class ChunkedPriorityQueue(gevent.queue.Queue):
 		return priority, queue[0]
 
 	def get_limit(self):
-		return min(self._limits.values()) if self._limits else None
+		return self.limit
+
+	def _update_limit(self):
+		self.limit = min(self._limits.values()) if self._limits else None
 
 	def set_limit(self, limit):
 		"""Sets base limit, or None to unset. Can still be made lower by limit_to() limits"""
@@ -80,6 +99,7 @@ class ChunkedPriorityQueue(gevent.queue.Queue):
 			self._limits.pop(None, None)
 		else:
 			self._limits[None] = limit
+		self._update_limit()
 		# try to unblock any pending gets using a dummy put,
 		# which schedules an _unlock() as a side effect
 		self.put(self.DUMMY)
@@ -90,8 +110,10 @@ class ChunkedPriorityQueue(gevent.queue.Queue):
 		class _LimitContext(object):
 			def __enter__(self):
 				parent._limits[self] = limit
+				parent._update_limit()
 			def __exit__(self, *exc_info):
 				del parent._limits[self]
+				parent._update_limit()
 				# try to unblock any pending gets using a dummy put
 				parent.put(parent.DUMMY)
 		return _LimitContext()
@@ -1,5 +1,6 @@
 
 import errno
+import itertools
 import json
 import logging
 import random
@@ -7,6 +8,7 @@ import string
 import time
 import weakref
 from base64 import b64encode, b64decode
+from collections import namedtuple
 
 import gevent.queue
 import gevent.pool
@@ -14,19 +16,32 @@ import gevent.event
 import gevent.lock
 from gevent import socket
 from gevent import ssl
+from monotonic import monotonic
 
 from girc import message
 from girc import replycodes
 from girc.handler import Handler, BoundHandler
 from girc.server_properties import ServerProperties
 from girc.channel import Channel
+from girc.userlist import UserListRouter
 from girc.chunkprioqueue import ChunkedPriorityQueue
-from girc.common import send_fd, recv_fd
+from girc.common import send_fd, recv_fd, recv_fd_and_data
+
+try:
+	intern
+except NameError:
+	from sys import intern
 
 
 DEFAULT_PORT = 6667
 
 
+# The cached form of a client's message handlers, see Client._get_handler_graph()
+HandlerGraph = namedtuple('HandlerGraph', [
+	'plan', 'sync_deps', 'graph', 'independent_sync', 'independent_async', 'referenced', 'commands',
+])
+
+
 class ConnectionClosed(Exception):
 	def __str__(self):
 		return "The connection was unexpectedly closed"
@@ -37,7 +52,7 @@ class Client(object):
 	started = False
 
 	# some insight into the state of _recv_loop to allow for smooth connection handoff
-	_recv_buf = b''
+	_recv_buf = None # bytearray of data that has been read but not processed, set in __init__
 	_kill_recv = False
 	_stopping = False
 
@@ -45,10 +60,16 @@ class Client(object):
 	WAIT_FOR_MESSAGES_TIMEOUT = 20
 	PING_IDLE_TIME = 60
 	PING_TIMEOUT = 30
+	SEND_BATCH_SIZE = 16 * 1024 # max bytes to write to the socket at once
+	RECV_SIZE = 64 * 1024 # max bytes to read from the socket at once
+	# If set, the size of the kernel's send and recv buffers for the socket.
+	# By default we leave this to the OS, as on linux setting it disables automatic buffer sizing.
+	SOCKET_BUFFER_SIZE = None
+	HANDOFF_MAX_SIZE = 1024 * 1024 # max size of handoff data when it is received in a single message
 
 	def __init__(self, hostname, nick, port=DEFAULT_PORT, password=None, nickserv_password=None,
 		         ident=None, real_name=None, stop_handler=[], logger=None, version='girc', time='local',
-		         twitch=False, ssl=False):
+		         twitch=False, ssl=False, send_queue_size=None):
 		"""Create a new IRC connection to given host and port.
 		ident and real_name are optional args that control how we report ourselves to the server
 		(they both default to nick).
@@ -66,6 +87,11 @@ class Client(object):
 		twitch=True sets some special behaviour for better operation with twitch.tv's unique variant of IRC.
 		ssl=True will cause the socket to connect using SSL.
 		ssl='insecure' will connect using SSL, however no attempt will be made to make the connection secure!
+		send_queue_size, if given, limits how many user messages (priority > 0) may be waiting to be sent.
+			Sending a message when the limit is reached will block until there is room.
+			Messages the library sends itself (priority <= 0) are never blocked.
+			Be careful sending many messages from a sync handler with this set, as that blocks
+			processing of further messages until there is room.
 		"""
 		self.hostname = hostname
 		self.port = port
@@ -79,17 +105,25 @@ class Client(object):
 		self._channels = {}
 		self._users = weakref.WeakValueDictionary()
 
-		self._recv_queue = gevent.queue.Queue()
+		self._recv_buf = bytearray()
+		# we recv into the same chunk each time instead of allocating a new bytes object per recv
+		self._recv_chunk = memoryview(bytearray(self.RECV_SIZE))
 		self._send_queue = ChunkedPriorityQueue()
+		# if set, a slot must be acquired to queue each user message, and is released once it's sent
+		self._send_slots = gevent.lock.Semaphore(send_queue_size) if send_queue_size else None
 		# Message priorities are used as follows:
 		# -2: Critical registration messages with strict ordering
 		# -1: PONGs sent in reply to PINGs, required to not get disconnected
 		# 0: Other high-priority tasks - changing NICK, sending idle PINGs, etc
 		# >0: User messages
 		self._group = gevent.pool.Group()
-		self._activity = gevent.event.Event() # set each time we send or recv, for idle watchdog
+		self._last_activity = monotonic() # updated each time we send or recv, for idle watchdog
+		self._send_queue_drained = gevent.event.Event() # set while everything queued has been sent
+		self._send_queue_drained.set()
 		self._stopped = gevent.event.AsyncResult() # contains None if exited cleanly, else set with exception
 		self.message_handlers = set() # set of Handler objects
+		self._handler_graph = None # cache for _get_handler_graph()
+		self._pong_waiters = {} # maps {payload: Event} for pending wait_for_messages() calls
 		self.stop_handlers = set()
 		self.server_properties = ServerProperties()
 
@@ -114,6 +148,8 @@ class Client(object):
 			logger = logging.getLogger(__name__).getChild(type(self).__name__)
 		self.logger = logger
 
+		self._user_list_router = UserListRouter(self)
+
 		if callable(stop_handler):
 			self.stop_handlers.add(stop_handler)
 		else:
@@ -141,7 +177,8 @@ class Client(object):
 		client = cls(**init_args)
 		client.logger.info("Initializing client from handoff args ({} channels)".format(len(channels)))
 		client._socket = sock
-		client._recv_buf = b64decode(recv_buf)
+		client._configure_socket()
+		client._recv_buf = bytearray(b64decode(recv_buf))
 		client.stop_handlers.add(lambda client: client._socket.close())
 
 		for name in channels:
@@ -173,21 +210,27 @@ class Client(object):
 		"""Takes a unix socket connection and uses it to receive a connection handoff.
 		Expects the remote process to send it a socket fd and handoff data - see client.handoff_to_sock()
 		While most init args are provided by handoff data, others (eg. logger) can be passed in as extra kwargs.
-		Note this method will block until the connection is closed.
+		If recv_sock is a SOCK_SEQPACKET socket, the fd and handoff data arrive together as one message.
+		Otherwise, this method will block until the connection is closed.
 		"""
 		connection = None
 		try:
-			# receive fd from other process
-			fd = recv_fd(recv_sock)
-			connection = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
-
-			# receive other args as json
-			handoff_data = ''
-			s = True
-			while s: # loop until closed
-				s = recv_sock.recv(4096)
-				handoff_data += s
-			handoff_data = json.loads(handoff_data)
+			if recv_sock.type == socket.SOCK_SEQPACKET:
+				fd, handoff_data = recv_fd_and_data(recv_sock, cls.HANDOFF_MAX_SIZE)
+				connection = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+			else:
+				# receive fd from other process
+				fd = recv_fd(recv_sock)
+				connection = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+
+				# receive other args as json
+				chunks = []
+				s = True
+				while s: # loop until closed
+					s = recv_sock.recv(4096)
+					chunks.append(s)
+				handoff_data = b''.join(chunks)
+			handoff_data = json.loads(handoff_data.decode('utf-8'))
 			if str is bytes:
 				handoff_data = {k: v.encode('utf-8') if isinstance(v, unicode) else v
 				                for k, v in handoff_data.items()}
@@ -206,6 +249,10 @@ class Client(object):
 	@property
 	def nick(self):
 		"""Get our current nick. May block if it is in the middle of being changed."""
+		# Fast path: if nobody holds the lock, the nick can't be mid-change, and since we're
+		# cooperatively scheduled nothing can take the lock between this check and the return.
+		if not self._nick_lock.locked():
+			return self._nick
 		with self._nick_lock:
 			return self._nick
 
@@ -291,16 +338,24 @@ class Client(object):
 		"""
 		return Handler(client=self, callback=callback, **match_args)
 
-	def _send(self, message, callback, priority):
+	def _send(self, message, callback, priority, inline=False):
 		"""A low level interface to send a message. You normally want to use Message.send() instead.
 		Callback is called after message is sent, and takes args (client, message).
-		Callback may be None.
+		Callback may be None. If inline=True, callback is called directly by the send loop
+		instead of in its own greenlet.
 		"""
 		self.logger.debug("Queuing message {} at prio {}".format(message, priority))
 		if self._stopping:
 			self.logger.debug("Dropping message as we are stopping")
 			return
-		self._send_queue.put((priority, (message, callback)))
+		if self._send_slots and priority > 0:
+			self._send_slots.acquire()
+			if self._stopping:
+				self._send_slots.release() # pass it on, so any other waiting senders also give up
+				self.logger.debug("Dropping message as we stopped while waiting to send")
+				return
+		self._send_queue_drained.clear()
+		self._send_queue.put((priority, (message, callback, inline)))
 
 	def _start_greenlets(self):
 		"""Start standard greenlets that should always run, and put them in a dict indexed by their name,
@@ -326,6 +381,7 @@ class Client(object):
 				self._socket = context.wrap_socket(self._socket, server_hostname=self.hostname)
 			self.stop_handlers.add(lambda self: self._socket.close())
 			self._socket.connect((self.hostname, self.port))
+			self._configure_socket()
 		except Exception as ex:
 			self.logger.exception("Error while connecting client")
 			self.stop(ex)
@@ -369,13 +425,25 @@ class Client(object):
 
 			self.logger.debug("Registration complete")
 
+	def _configure_socket(self):
+		"""Set socket options for a newly connected or handed off socket"""
+		# We write whole messages (or batches of them) at once, so Nagle's algorithm would only add latency,
+		# which matters most for PONGs.
+		self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		if self.SOCKET_BUFFER_SIZE:
+			self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCKET_BUFFER_SIZE)
+			self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_BUFFER_SIZE)
+
 	def _idle_watchdog(self):
 		"""Sends a ping if no activity for PING_IDLE_TIME seconds.
 		Disconnect if there is no response within PING_TIMEOUT seconds."""
 		try:
 			while True:
-				if self._activity.wait(self.PING_IDLE_TIME):
-					self._activity.clear()
+				# Rather than wake up for every message, we sleep until PING_IDLE_TIME after the last activity
+				# we know of, then check if there's been any more since.
+				idle_in = self._last_activity + self.PING_IDLE_TIME - monotonic()
+				if idle_in > 0:
+					gevent.sleep(idle_in)
 					continue
 				self.logger.info("No activity for {}s, sending PING".format(self.PING_IDLE_TIME))
 				if not self.wait_for_messages(self.PING_TIMEOUT, priority=0):
@@ -394,23 +462,36 @@ class Client(object):
 					return
 				self._recv_waiting = True
 				try:
-					data = self._socket.recv(4096)
+					size = self._socket.recv_into(self._recv_chunk)
 				except socket.error as ex:
 					if ex.errno == errno.EINTR: # retry on EINTR
 						continue
 					raise
 				finally:
 					self._recv_waiting = False
-				if not data:
+				if not size:
 					self.logger.info("no data from recv, socket closed")
 					break
-				lines = (self._recv_buf + data).split(b'\r\n')
-				self._recv_buf = lines.pop() # everything after final \r\n
+				# We append to the buffer in place and cut out each complete line, rather than
+				# re-copying the whole buffer on every recv.
+				buf = self._recv_buf
+				buf += self._recv_chunk[:size]
+				lines = []
+				start = 0
+				end = buf.find(b'\r\n')
+				while end >= 0:
+					lines.append(bytes(buf[start:end]))
+					start = end + 2
+					end = buf.find(b'\r\n', start)
+				del buf[:start] # leave everything after final \r\n
 				if lines:
-					self._activity.set()
+					self._last_activity = monotonic()
 				for line in lines:
-					line = line.decode('utf-8', 'surrogateescape')
 					self._process(line)
+				# Processing may not have yielded at all (eg. if all handlers ran inline), and under
+				# sustained traffic recv_into() won't block either. So we yield here, otherwise
+				# spawned handlers and the send loop (including our PONGs) would never get to run.
+				gevent.idle()
 		except Exception as ex:
 			self.logger.exception("error in _recv_loop")
 			error = ex
@@ -422,22 +503,52 @@ class Client(object):
 		send_queue = self._send_queue
 		try:
 			while True:
-				priority, (message, callback) = send_queue.get()
-				line = "{}\r\n".format(message.encode())
-				self.logger.debug("Sending message: {!r}".format(line))
+				# We write everything that is ready to send (up to SEND_BATCH_SIZE bytes) in one go,
+				# instead of one write per message. The queue gives us messages in priority order,
+				# so this doesn't change the order they are sent in.
+				batch = []
+				lines = []
+				priorities = []
+				size = 0
+				while not batch or (size < self.SEND_BATCH_SIZE and not send_queue.empty()):
+					priority, (message, callback, inline) = send_queue.get()
+					line = message.encode()
+					self.logger.debug("Sending message: {!r}".format(line))
+					batch.append((message, callback, inline))
+					lines.append(line)
+					priorities.append(priority)
+					size += len(line) + 2 # close enough, as this is only a limit on batch size
+					if message.command == 'QUIT':
+						break # nothing after a QUIT should be sent
+				# we join and encode the whole batch at once, rather than each line
+				data = '\r\n'.join(lines) + '\r\n'
 				if str is not bytes:
-					line = line.encode('utf-8', 'surrogateescape')
+					data = data.encode('utf-8', 'surrogateescape')
 				try:
-					self._socket.sendall(line)
+					self._socket.sendall(data)
 				except socket.error as ex:
 					if ex.errno == errno.EPIPE:
 						self.logger.info("failed to send, socket closed")
 						self.stop(ConnectionClosed())
 						return
 					raise
-				self._activity.set()
-				if callback is not None:
-					self._group.spawn(callback, self, message)
+				self._last_activity = monotonic()
+				if send_queue.empty():
+					self._send_queue_drained.set()
+				if self._send_slots:
+					for priority in priorities:
+						if priority > 0:
+							self._send_slots.release()
+				for message, callback, inline in batch:
+					if callback is None:
+						continue
+					if not (inline or getattr(callback, 'inline', False)):
+						self._group.spawn(callback, self, message)
+						continue
+					try:
+						callback(self, message)
+					except Exception:
+						self.logger.exception("Callback {} for sent message {} failed".format(callback, message))
 				if message.command == 'QUIT':
 					self.logger.info("QUIT sent, client shutting down")
 					self.stop()
@@ -447,10 +558,20 @@ class Client(object):
 			self.stop(ex)
 
 	def _process(self, line):
+		"""Decode and dispatch a single line, as raw bytes without the trailing \r\n"""
 		self.logger.debug("Received message: {!r}".format(line))
 		line = line.strip()
 		if not line:
 			return
+		# Most servers send plenty of messages nobody cares about, which we can skip without fully decoding.
+		# Note we don't bother removing commands when handlers go away, it just means we skip less.
+		commands = self._get_handler_graph().commands
+		if commands is not None:
+			command = message.peek_command(line)
+			# if command is None, peek_command() couldn't tell, so we decode it to find out
+			if command is not None and command not in commands:
+				return
+		line = line.decode('utf-8', 'surrogateescape')
 		try:
 			msg = message.decode(line, self)
 		except message.InvalidMessage:
@@ -459,46 +580,192 @@ class Client(object):
 		self.logger.debug("Getting handlers for message: {}".format(msg))
 		self._dispatch_handlers(msg)
 
-	def _dispatch_handlers(self, msg):
-		"""Carefully builds a set of greenlets for all message handlers, obeying ordering metadata for each handler.
-		Returns when all sync=True handlers have been executed."""
-		def normalize(handler):
-			# handler might be a Handler, BoundHandler or "sync"
-			return handler.handler if isinstance(handler, BoundHandler) else handler
+	def _invalidate_handler_graph(self):
+		"""Called whenever message_handlers changes, so the handler graph will be rebuilt on next use."""
+		self._handler_graph = None
+
+	def _handler_added(self, handler):
+		"""Called when handler is added to message_handlers.
+		Many handlers are short-lived and have no ordering constraints (eg. those from wait_for()
+		and wait_for_messages()), so rather than rebuild the whole handler graph we add those directly."""
+		if self._handler_graph is None:
+			return
+		cache = self._handler_graph
+		sync = 'sync' in handler.before
+		if (
+			handler.after or len(handler.before) > sync # has ordering constraints
+			or handler in cache.referenced # some other handler is ordered relative to it
+			or (sync and 'sync' in cache.referenced) # something runs after='sync', so must wait for it
+		):
+			self._invalidate_handler_graph()
+			return
+		commands = handler.get_commands()
+		if commands is None and cache.commands is not None:
+			self._invalidate_handler_graph() # this handler breaks the "only these commands" filter
+			return
+		if commands is not None and cache.commands is not None:
+			cache.commands.update(commands)
+		independent = cache.independent_sync if sync else cache.independent_async
+		for command in [None] if commands is None else commands:
+			independent[command] = independent.get(command, ()) + (handler,)
+
+	def _handler_removed(self, handler):
+		"""Called when handler is removed from message_handlers. As per _handler_added(),
+		handlers without ordering constraints are removed from the handler graph directly."""
+		if self._handler_graph is None:
+			return
+		cache = self._handler_graph
+		if handler in cache.graph:
+			self._invalidate_handler_graph()
+			return
+		independent = cache.independent_sync if 'sync' in handler.before else cache.independent_async
+		commands = handler.get_commands()
+		try:
+			for command in [None] if commands is None else commands:
+				handlers = list(independent[command])
+				handlers.remove(handler)
+				if handlers:
+					independent[command] = tuple(handlers)
+				else:
+					del independent[command]
+		except (KeyError, ValueError):
+			# handler must have changed since it was added, give up and rebuild from scratch
+			self._invalidate_handler_graph()
+
+	@staticmethod
+	def _normalize_handler(handler):
+		# handler might be a Handler, BoundHandler or "sync"
+		return handler.handler if isinstance(handler, BoundHandler) else handler
+
+	def _get_handler_graph(self):
+		"""Returns a HandlerGraph describing how to dispatch messages to the current message handlers:
+		graph is a dict mapping each handler that has ordering constraints (and the special value 'sync')
+		to the set of handlers which must complete before it.
+		plan is a list of (handler, deps) for each handler in graph, such that each comes after all the
+		handlers it depends on. Dependencies on 'sync' are replaced with the handlers it waits for.
+		sync_deps is a tuple of the handlers in plan which must finish before dispatch is complete.
+		independent_sync and independent_async contain handlers with no ordering constraints,
+		other than sync=True for the former. They map each command (as per message.command_key())
+		to the handlers which could match that command, with None mapping to handlers for any command.
+		These are tuples, which are replaced rather than modified, so dispatch can safely iterate over them
+		even if handlers are added or removed meanwhile.
+		referenced is the set of all handlers that any message handler is ordered relative to,
+		including 'sync' if any handler runs after='sync'.
+		commands is the set of all commands any handler could match, or None if any handler matches all commands.
+		This only depends on the set of registered handlers, so it's cached until that changes.
+		Raises ValueError if handlers have cyclic dependencies."""
+		if self._handler_graph is not None:
+			return self._handler_graph
+		normalize = self._normalize_handler
 		# build dependency graph
 		graph = {handler: set() for handler in self.message_handlers}
 		graph['sync'] = set()
+		referenced = set()
 		for handler in self.message_handlers:
 			for other in map(normalize, handler.after):
+				referenced.add(other)
 				if other in graph:
 					graph[handler].add(other)
 			for other in map(normalize, handler.before):
+				if other != 'sync':
+					referenced.add(other)
 				if other in graph:
 					graph[other].add(handler)
-		# check for cycles
-		def check_cycles(handler, chain=()):
-			if handler in chain:
-				chain_text = " -> ".join(map(str, chain + (handler,)))
-				raise ValueError("Dependency cycle in handlers: {}".format(chain_text))
-			chain += handler,
-			for dep in graph[handler]:
-				check_cycles(dep, chain)
-		for handler in graph:
-			check_cycles(handler)
-		# set up the greenlets
+		# sort into dependency order (Kahn's algorithm), which also finds any cycles
+		waiting = {handler: len(deps) for handler, deps in graph.items()} # number of unsorted deps
+		dependents = {handler: [] for handler in graph}
+		for handler, deps in graph.items():
+			for dep in deps:
+				dependents[dep].append(handler)
+		ready = [handler for handler, count in waiting.items() if not count]
+		order = []
+		while ready:
+			handler = ready.pop()
+			order.append(handler)
+			for dependent in dependents[handler]:
+				waiting[dependent] -= 1
+				if not waiting[dependent]:
+					ready.append(dependent)
+		if len(order) < len(graph):
+			# Every unsorted handler has an unsorted dep, so following them must eventually loop.
+			chain = [next(handler for handler, count in waiting.items() if count)]
+			while True:
+				handler = next(dep for dep in graph[chain[-1]] if waiting[dep])
+				if handler in chain:
+					chain = chain[chain.index(handler):] + [handler]
+					chain_text = " -> ".join(map(str, chain))
+					raise ValueError("Dependency cycle in handlers: {}".format(chain_text))
+				chain.append(handler)
+		# split out handlers which don't need to wait for or be waited on by any other handler
+		depended_on = set()
+		for handler, deps in graph.items():
+			if handler != 'sync':
+				depended_on |= deps
+		independent_sync = {}
+		independent_async = {}
+		all_commands = set()
+		for handler in self.message_handlers:
+			if all_commands is not None:
+				commands = handler.get_commands()
+				all_commands = None if commands is None else all_commands | commands
+			if graph[handler] or handler in depended_on:
+				continue
+			if handler in graph['sync']:
+				if 'sync' in depended_on:
+					continue # something runs after='sync', so the sync step must really wait for handler
+				independent = independent_sync
+				graph['sync'].remove(handler)
+			else:
+				independent = independent_async
+			del graph[handler]
+			commands = handler.get_commands()
+			for command in [None] if commands is None else commands:
+				independent.setdefault(command, []).append(handler)
+		sync_deps = tuple(graph['sync'])
+		plan = []
+		for handler in order:
+			if handler == 'sync' or handler not in graph:
+				continue
+			deps = graph[handler]
+			if 'sync' in deps:
+				deps = (deps - {'sync'}) | graph['sync']
+			plan.append((handler, tuple(deps)))
+		self._handler_graph = HandlerGraph(
+			plan, sync_deps, graph,
+			{command: tuple(handlers) for command, handlers in independent_sync.items()},
+			{command: tuple(handlers) for command, handlers in independent_async.items()},
+			referenced, all_commands,
+		)
+		return self._handler_graph
+
+	def _dispatch_handlers(self, msg):
+		"""Carefully builds a set of greenlets for all message handlers, obeying ordering metadata for each handler.
+		Returns when all sync=True handlers have been executed."""
+		cache = self._get_handler_graph()
+		# Set up the greenlets for handlers with ordering constraints.
+		# Since we spawn them in dependency order, they will usually find their deps have already finished.
 		greenlets = {}
-		def wait_and_handle(handler):
-			for dep in graph[handler]:
+		def wait_and_handle(handler, deps):
+			for dep in deps:
 				greenlets[dep].join()
 			return handler.handle(self, msg)
-		def wait_for_sync():
-			for dep in graph['sync']:
-				greenlets[dep].join()
-		for handler in self.message_handlers:
-			greenlets[handler] = self._group.spawn(wait_and_handle, handler)
-		greenlets['sync'] = self._group.spawn(wait_for_sync)
-		# wait for sync to finish
-		greenlets['sync'].get()
+		for handler, deps in cache.plan:
+			greenlets[handler] = self._group.spawn(wait_and_handle, handler, deps)
+		# Most handlers have no ordering constraints, and most of those won't match any given message.
+		# So we only check the ones for this command (or any command) here and only spawn a greenlet
+		# for the async ones that match, while sync ones we can simply call directly.
+		# Note this means dispatch may not yield at all, so _recv_loop must yield between batches.
+		command = message.command_key(msg.command)
+		# (adding an empty tuple returns the other one as is, so usually this doesn't need to copy anything)
+		for handler in cache.independent_sync.get(command, ()) + cache.independent_sync.get(None, ()):
+			if handler.matches(self, msg):
+				handler.handle_matched(self, msg)
+		for handler in cache.independent_async.get(command, ()) + cache.independent_async.get(None, ()):
+			if handler.matches(self, msg):
+				self._group.spawn(handler.handle_matched, self, msg)
+		# wait for sync handlers to finish
+		for dep in cache.sync_deps:
+			greenlets[dep].join()
 
 	def stop(self, ex=None):
 		if self._stopping:
@@ -514,15 +781,18 @@ class Client(object):
 
 			# post-stop: we clear a few structures to break reference loops
 			# since they no longer make sense.
-			for channel in self._channels.values():
-				channel.client = None
-			for user in self._users.values():
-				user.client = None
-			for handler in self.message_handlers.copy():
+			for obj in itertools.chain(self._channels.values(), self._users.values()):
+				obj.client = None
+			# take the whole set of handlers at once, rather than copying it
+			handlers, self.message_handlers = self.message_handlers, set()
+			self._handler_graph = None
+			for handler in handlers:
 				handler.unregister_for_client(self)
-			# queues might contain some final messages
+			# wake anything waiting for room in the send queue, so it can see we've stopped
+			if self._send_slots:
+				self._send_slots.release()
+			# queue might contain some final messages
 			self._send_queue = None
-			self._recv_queue = None
 
 			# act of setting _stopped will make wait_for_stop()s fire
 			if ex:
@@ -575,22 +845,17 @@ class Client(object):
 		"""This function will attempt to block until the server has received and processed
 		all current messages. We rely on the fact that servers will generally react to messages
 		in order, and so we queue up a Ping and wait for the corresponding Pong."""
-		# We're conservative here with our payload - 8 characters only, letters and digits,
-		# and we assume it's case insensitive. This still gives us about 40 bits of information.
+		# We're conservative here with our payload - 8 characters only, lowercase hex digits,
+		# and we assume it's case insensitive. This still gives us 32 bits of information.
 		# Also, some servers set the payload to their server name in the reply
 		# and attach the payload as a second arg. Finally, we just dump a reasonable timeout
 		# over the whole thing, just in case.
-		payload = ''.join(random.choice(string.ascii_lowercase + string.digits) for x in range(8))
-		received = gevent.event.Event()
-		def match_payload(params):
-			return any(value.lower() == payload for value in params)
-		@self.handler(command=message.Pong, params=match_payload)
-		def on_pong(client, msg):
-			received.set()
-			return True # unregister
-		message.Ping(self, payload).send()
+		payload = '{:08x}'.format(random.getrandbits(32))
+		received = self._pong_waiters[payload] = gevent.event.Event() # see on_pong()
+		message.Ping(self, payload).send(priority=priority)
 		if received.wait(self.WAIT_FOR_MESSAGES_TIMEOUT if timeout is None else timeout):
 			return True
+		self._pong_waiters.pop(payload, None)
 		self.logger.warning("Timed out while waiting for matching pong in wait_for_messages()")
 		return False
 
@@ -602,18 +867,30 @@ class Client(object):
 		"""Ensures that a channel name has a correct prefix, defaulting to the first entry in CHANTYPES."""
 		if not name:
 			raise ValueError("Channel name cannot be empty")
-		if name[0] in self.server_properties.CHANTYPES:
-			return name
-		return "{prefix}{name}".format(name=name, prefix=self.server_properties.CHANTYPES[0])
+		chantypes = self.server_properties.CHANTYPES
+		if name[0] not in chantypes:
+			name = "{prefix}{name}".format(name=name, prefix=chantypes[0])
+		# channel names are looked up constantly, and interning makes those lookups cheaper
+		return intern(name)
 
 	@Handler(command=message.ISupport, sync=True)
 	def recv_support(self, client, msg):
 		self.server_properties.update(msg.properties)
 
+	# Deliberately not sync=True, so it's spawned rather than run inline by the recv loop,
+	# and can reply while a slow sync handler for another message is still blocking.
 	@Handler(command=message.Ping)
 	def on_ping(self, client, msg):
 		message.Pong(client, msg.payload).send(priority=-1)
 
+	@Handler(command=message.Pong, sync=True)
+	def on_pong(self, client, msg):
+		# wake any wait_for_messages() call waiting on this payload
+		for value in msg.params:
+			received = self._pong_waiters.pop(value.lower(), None)
+			if received:
+				received.set()
+
 	@Handler(command=replycodes.errors.NICKNAMEINUSE, sync=True)
 	def nick_in_use(self, client, msg):
 		server_nick, bad_nick = msg.params[:2] # server_nick is what server thinks our nick is right now
@@ -651,6 +928,22 @@ class Client(object):
 			channel = self.channel(name)
 			channel._join()
 
+	# Channel-specific messages are handled here and passed on to the relevant Channel,
+	# rather than having every Channel register its own handlers and check every message.
+
+	@Handler(command='PART', sender=matches_nick, sync=True)
+	def forced_part(self, client, msg):
+		for name in msg.channels:
+			channel = self._channels.get(name)
+			if channel:
+				channel._recv_part(client, msg)
+
+	@Handler(command=replycodes.replies.ENDOFNAMES, params=lambda params: len(params) > 1, sync=True)
+	def end_of_names(self, client, msg):
+		channel = self._channels.get(msg.params[1])
+		if channel:
+			channel._recv_end_of_names(client, msg)
+
 	@Handler(command='PRIVMSG', ctcp=lambda v: v and v[0].upper() == 'VERSION')
 	def ctcp_version(self, client, msg):
 		if self.version:
@@ -676,7 +969,7 @@ class Client(object):
 		"""Collect all data needed for a connection handoff and return as dict.
 		Make sure _prepare_for_handoff has been called first."""
 		data = dict(
-			recv_buf = b64encode(self._recv_buf),
+			recv_buf = b64encode(self._recv_buf), # b64encode can read the bytearray directly, no need to copy it
 			channels = [channel.name for channel in self._channels.values() if channel.joined],
 			hostname = self.hostname,
 			nick = self._nick,
@@ -686,7 +979,7 @@ class Client(object):
 			real_name = self.real_name,
 		)
 		if str is not bytes:
-			data['recv_buf'] = data['recv_buf'].encode()
+			data['recv_buf'] = data['recv_buf'].decode('ascii')
 		return data
 
 	def _prepare_for_handoff(self):
@@ -715,12 +1008,7 @@ class Client(object):
 		# since we need to clear send queue, it makes no sense to try to hand off while it is limited
 		if self._send_queue.get_limit() is not None:
 			raise Exception("Can't hand off while send queue is limited")
-		# We re-use the activity flag to check queue after each message is sent
-		while True:
-			self._activity.clear()
-			if self._send_queue.empty():
-				break
-			self._activity.wait()
+		self._send_queue_drained.wait()
 
 		# final state: recv loop is stopped, send loop is hung as no further messages can be queued and queue is empty
 
@@ -730,11 +1018,13 @@ class Client(object):
 
 	def handoff_to_sock(self, send_sock):
 		"""Takes a unix socket and hands off connection to other process via it.
-		Note that the receiving end will not complete until you close the connection."""
+		If send_sock is a SOCK_SEQPACKET socket, everything is sent as a single message.
+		Otherwise, the receiving end will not complete until you close the connection."""
 		self._prepare_for_handoff()
-		handoff_data = json.dumps(self._get_handoff_data())
+		handoff_data = json.dumps(self._get_handoff_data(), separators=(',', ':'))
+		if str is not bytes:
+			handoff_data = handoff_data.encode('utf-8')
 
-		send_fd(send_sock, self._socket)
-		send_sock.sendall(handoff_data)
+		send_fd(send_sock, self._socket, handoff_data)
 
 		self._finalize_handoff()
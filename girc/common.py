@@ -1,5 +1,7 @@
 
+import array
 import multiprocessing.reduction
+import socket
 from collections import defaultdict
 
 from gevent.select import select
@@ -75,24 +77,51 @@ def int_equals(a, b):
 		return False
 
 
-def send_fd(sock, fd):
-	"""Send an fd over a unix socket"""
+def send_fd(sock, fd, data=b''):
+	"""Send an fd over a unix socket, optionally followed by data.
+	Where possible, the fd and data are sent together in one sendmsg() call.
+	The other end should recv_fd() then read data as normal."""
 	if hasattr(fd, 'fileno'):
 		fd = fd.fileno()
-	while True:
-		r, w, x = select([], [sock], [])
-		if not w:
-			continue
+	# The actual send may not be gevent-aware (send_handle() uses its own non-gevent socket),
+	# so we wait for the socket to be ready first to avoid blocking other greenlets.
+	# With no timeout, select() only returns once it is ready.
+	select([], [sock], [])
+	if not hasattr(sock, 'sendmsg'):
 		multiprocessing.reduction.send_handle(sock, fd, None)
-		break
+		sock.sendall(data)
+		return
+	# As per multiprocessing.reduction.send_handle(), the fd is attached to a single byte,
+	# so that recv_fd() reads exactly that byte and leaves the data for the caller.
+	ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))]
+	sent = sock.sendmsg([b'\x01', data], ancillary)
+	if sent < 1 + len(data):
+		sock.sendall(memoryview(data)[max(sent - 1, 0):])
 
 
 def recv_fd(sock):
 	"""Receive an fd from a unix socket.
 	Note this function returns a raw integer fd. You probably want to os.fdopen() or socket.fromfd() it.
 	"""
-	while True:
-		r, w, x = select([sock], [], [])
-		if not r:
-			continue
-		return multiprocessing.reduction.recv_handle(sock)
+	# as in send_fd(), wait until ready as recv_handle() isn't gevent-aware
+	select([sock], [], [])
+	return multiprocessing.reduction.recv_handle(sock)
+
+
+def recv_fd_and_data(sock, max_size):
+	"""Receive an fd and data sent together by send_fd(), over a unix socket which preserves
+	message boundaries (ie. SOCK_SEQPACKET). The data must be at most max_size bytes.
+	Returns (fd, data). As with recv_fd(), fd is a raw integer fd.
+	"""
+	fd_size = array.array('i').itemsize
+	select([sock], [], []) # as in send_fd(), the socket may not be gevent-aware
+	# the first byte is the one the fd was attached to, see send_fd()
+	data, ancillary, flags, addr = sock.recvmsg(1 + max_size, socket.CMSG_SPACE(fd_size))
+	if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+		raise ValueError("Received data was truncated (more than {} bytes?)".format(max_size))
+	for level, type, fd_data in ancillary:
+		if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+			fds = array.array('i')
+			fds.frombytes(fd_data[:fd_size])
+			return fds[0], data[1:]
+	raise ValueError("No fd was received")
@@ -2,6 +2,11 @@
 from girc import message
 from girc.common import iterable
 
+try:
+	basestring
+except NameError:
+	basestring = str
+
 
 class Handler(object):
 	"""A handler object manages a handler callback.
@@ -45,10 +50,12 @@ class Handler(object):
 		Client may be omitted, in which case the handler must later be bound to a client with handler.register().
 		"""
 		self.match_list = [] # list of match_args dicts to match on
+		self.matchers = [] # compiled form of match_list, see message.compile_match()
+		self._commands = frozenset() # cached result of get_commands()
 		self.client_binds = {} # maps {client: set(instances to bind and call)}
 
-		self.before = set(before) if iterable(before) else [before]
-		self.after = set(after) if iterable(after) else [after]
+		self.before = self._to_set(before)
+		self.after = self._to_set(after)
 		if sync:
 			self.before.add('sync')
 
@@ -57,42 +64,96 @@ class Handler(object):
 		if client:
 			self.register(client)
 
+	@staticmethod
+	def _to_set(value):
+		"""For before and after args, which may be a single value (including 'sync') or an iterable"""
+		if isinstance(value, basestring) or not iterable(value):
+			return {value}
+		return set(value)
+
 	def __repr__(self):
 		return "<{cls.__name__}({self.callback})>".format(cls=type(self), self=self)
 
 	def add_match(self, **match_args):
 		"""Add a new set of match_args to the handler. Either this new set or the existing set matching will
-		trigger the handler."""
+		trigger the handler. Adding a set of match_args the handler already has does nothing."""
+		if match_args in self.match_list:
+			return
 		self.match_list.append(match_args)
+		self.matchers.append(message.compile_match(**match_args))
+		if self._commands is not None:
+			command = match_args.get('command')
+			if command is None:
+				self._commands = None
+			else:
+				if isinstance(command, basestring) or not iterable(command):
+					command = [command]
+				self._commands = self._commands.union(map(message.command_key, command))
+		for client in self.client_binds:
+			client._invalidate_handler_graph()
+
+	def get_commands(self):
+		"""Returns the set of commands (normalized with message.command_key()) which this handler could match,
+		or None if it could match any command."""
+		return self._commands
 
 	def register(self, client, instance=None):
 		"""Register handler with a client. Optional arg instance is for internal use, and is used to implement
 		the "call with callback bound to instance" functionality as described in the class docstring."""
 		self.client_binds.setdefault(client, set()).add(instance)
-		client.message_handlers.add(self)
+		if self not in client.message_handlers:
+			client.message_handlers.add(self)
+			client._handler_added(self)
 		client.logger.info("Registering handler {} with match args {}".format(self, self.match_list))
 
 	def unregister(self, client, instance=None):
 		"""Remove association of handler with client."""
 		# note: if instance given, we only want to disassociate that instance with that client,
 		# unless it is the last bind for that client.
-		if client not in self.client_binds:
+		binds = self.client_binds.get(client)
+		if binds is None:
 			return
-		self.client_binds[client].discard(instance)
-		if not self.client_binds[client]:
-			client.message_handlers.discard(self)
+		binds.discard(instance)
+		if not binds:
+			if self in client.message_handlers:
+				client.message_handlers.discard(self)
+				client._handler_removed(self)
 			del self.client_binds[client]
 
 	@classmethod
 	def find_handlers(cls, instance):
 		"""Returns a set of BoundHandlers for Handlers that are methods for given instance."""
 		result = set()
-		for attr in dir(instance):
+		for attr in cls._handler_names(type(instance)):
 			value = getattr(instance, attr)
 			if isinstance(value, BoundHandler):
 				result.add(value)
+		# handlers may also be bound directly on the instance
+		for value in getattr(instance, '__dict__', {}).values():
+			if isinstance(value, BoundHandler):
+				result.add(value)
 		return result
 
+	@staticmethod
+	def _handler_names(owner):
+		"""Returns the names of attributes of class owner (or its bases) which are Handlers.
+		This is worked out once per class by looking at the class dicts directly, so unlike dir() + getattr()
+		it doesn't trigger any unrelated descriptors. The result is cached on the class."""
+		names = vars(owner).get('_girc_handler_names')
+		if names is not None:
+			return names
+		names = []
+		seen = set()
+		for klass in owner.__mro__:
+			for name, value in vars(klass).items():
+				if name in seen:
+					continue # overridden by a subclass
+				seen.add(name)
+				if isinstance(value, Handler):
+					names.append(name)
+		owner._girc_handler_names = names
+		return names
+
 	@classmethod
 	def register_all(cls, client, instance):
 		"""Find methods of the given instance that are Handlers, and register them to client."""
@@ -131,13 +192,22 @@ class Handler(object):
 		return self(instance, client, msg) if instance else self(client, msg)
 
 	def handle(self, client, msg):
+		if self.matches(client, msg):
+			self.handle_matched(client, msg)
+
+	def matches(self, client, msg):
+		"""Returns whether msg matches any of the handler's match args"""
 		try:
-			if not any(message.match(msg, **match_args) for match_args in self.match_list):
-				return
+			return any(matcher(msg) for matcher in self.matchers)
 		except message.InvalidMessage:
 			client.logger.warning("Problem with message {} while matching handler {}".format(msg, self),
 			                      exc_info=True)
-			return
+		except Exception:
+			client.logger.exception("Error while matching message {} against handler {}".format(msg, self))
+		return False
+
+	def handle_matched(self, client, msg):
+		"""As handle(), but assumes msg has already been checked against the match args"""
 		if not self.callback:
 			return
 		client.logger.debug("Handling message {} with handler {}".format(msg, self))
@@ -153,7 +223,11 @@ class Handler(object):
 
 
 class BoundHandler(object):
-	"""A wrapper around a handler that applies the bound instance to certain operations."""
+	"""A wrapper around a handler that applies the bound instance to certain operations.
+	A new one is created every time a handler method is looked up on an instance, so it uses __slots__."""
+
+	__slots__ = ('handler', 'instance')
+
 	def __init__(self, handler, instance):
 		self.handler = handler
 		self.instance = instance
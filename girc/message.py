@@ -8,13 +8,18 @@ import gevent
 from monotonic import monotonic
 
 from girc import replycodes
-from girc.common import classproperty, subclasses, iterable, int_equals
+from girc.common import classproperty, subclasses, iterable
 
 try:
 	basestring
 except NameError:
 	basestring = str
 
+try:
+	intern
+except NameError:
+	from sys import intern
+
 class InvalidMessage(Exception):
 	def __init__(self, data, message):
 		self.data = data
@@ -33,28 +38,42 @@ TAG_ESCAPES = {
 }
 TAG_UNESCAPES = {v: k for k, v in TAG_ESCAPES.items()}
 
-def _translate_escapes(mapping, value):
-	result = ''
-	buf = ''
-	for c in value:
-		buf += c
-		if buf in mapping:
-			result += mapping[buf]
-			buf = ''
-		elif any(key.startswith(buf) for key in mapping):
-			pass # allow buf to continue growing
-		else:
-			result += buf
-			buf = ''
-	result += buf
-	return result
+def _escapes_regex(mapping):
+	"""Returns a compiled regex matching any key of mapping, so that the scan for escapes
+	happens in a single C-level pass instead of character by character."""
+	# longest first, so that a key which is a prefix of another never shadows it
+	keys = sorted(mapping, key=len, reverse=True)
+	return re.compile('|'.join(map(re.escape, keys)))
+
+TAG_ESCAPES_RE = _escapes_regex(TAG_ESCAPES)
+TAG_UNESCAPES_RE = _escapes_regex(TAG_UNESCAPES)
+
+def _translate_escapes(mapping, regex, value):
+	return regex.sub(lambda match: mapping[match.group()], value)
 
 def encode_tag_value(value):
-	return _translate_escapes(TAG_ESCAPES, value)
+	# most values need no escaping, in which case we can skip building a new string
+	if not TAG_ESCAPES_RE.search(value):
+		return value
+	return _translate_escapes(TAG_ESCAPES, TAG_ESCAPES_RE, value)
 
 def decode_tag_value(value):
-	return _translate_escapes(TAG_UNESCAPES, value)
+	# all escapes begin with a backslash, so a plain substring check tells us if there are any
+	if '\\' not in value:
+		return value
+	return _translate_escapes(TAG_UNESCAPES, TAG_UNESCAPES_RE, value)
+
+
+ILLEGAL_CHARS = re.compile('[\r\n\0]')
+SPACES = re.compile(' +')
 
+def _split_word(line):
+	"""Returns (first word, remainder) of line, ignoring multiple consecutive spaces.
+	Line should not begin with a space."""
+	parts = SPACES.split(line, 1)
+	if len(parts) == 1:
+		return parts[0], ''
+	return parts
 
 def decode(line, client):
 	"""Decode a message. Client is needed as some messages require server properties to parse correctly."""
@@ -63,38 +82,24 @@ def decode(line, client):
 	host = None
 	tags = None
 
-	line = line.strip('\r\n')
-	for c in '\r\n\0':
-		if c in line:
-			raise InvalidMessage(line, "Illegal character {!r}".format(c))
-
-	remaining_line = [line]
-	def split_word():
-		# Get next word, ignoring multiple consecutive spaces.
-		# Returns (word, remainder). remainder may begin with space.
-		# Note word == '' if and only if remaining_line == ''
-		parts = remaining_line[0].lstrip(' ').split(' ', 1)
-		if len(parts) == 1:
-			return parts[0], ''
-		return parts
-	def peek_word():
-		word, remainder = split_word()
-		return word
-	def pop_word():
-		word, remainder = split_word()
-		remaining_line[0] = remainder
-		return word
+	line = line.rstrip('\r\n')
+	illegal = ILLEGAL_CHARS.search(line)
+	if illegal:
+		raise InvalidMessage(line, "Illegal character {!r}".format(illegal.group()))
+
+	remaining = line.lstrip(' ')
 
 	# IRCv3 message tags
-	if peek_word().startswith('@'):
-		tags = pop_word()
-		tags = tags[1:] # strip leading @
-		tags = tags.split(';')
-		tags = [tag.split('=', 1) if '=' in tag else (tag, True) for tag in tags]
-		tags = {key: decode_tag_value(value) for key, value in tags}
-
-	if peek_word().startswith(':'):
-		prefix = pop_word()
+	if remaining.startswith('@'):
+		tags, remaining = _split_word(remaining)
+		tags_str = tags[1:] # strip leading @
+		tags = {}
+		for tag in tags_str.split(';'):
+			key, has_value, value = tag.partition('=')
+			tags[key] = decode_tag_value(value) if has_value else True
+
+	if remaining.startswith(':'):
+		prefix, remaining = _split_word(remaining)
 		prefix = prefix[1:] # strip leading :
 		if '@' in prefix:
 			# as user may contain a '@', we need to take only the last @
@@ -105,17 +110,18 @@ def decode(line, client):
 			prefix, user = prefix.split('!', 1)
 		sender = prefix
 
-	if peek_word() == '':
+	# everything after the first word beginning with : should be copied verbatim, without splitting
+	# (we prepend a space so that this also works when it is the first word)
+	remaining, has_trailing, trailing = (' ' + remaining).partition(' :')
+	remaining = remaining.strip(' ')
+	if not remaining:
 		raise InvalidMessage(line, "no command given")
-	command = pop_word().upper()
-
-	params = []
-	while peek_word():
-		if peek_word().startswith(':'):
-			# everything after the : should be copied verbatim, without splitting
-			params.append(remaining_line[0].lstrip()[1:])
-			break
-		params.append(pop_word())
+	params = SPACES.split(remaining)
+	# commands come from a small set, so by interning them we only store each once,
+	# and comparisons and dict lookups of commands usually succeed on identity alone
+	command = intern(params.pop(0).upper())
+	if has_trailing:
+		params.append(trailing)
 
 	try:
 		return Message(client, command, *params, sender=sender, user=user, host=host, tags=tags)
@@ -135,6 +141,12 @@ class MessageDispatchMeta(type):
 	"""A metatype that overrides Message() so we can dispatch the construction out to the revelant Command."""
 	# I originally tried to implement this with Message.__new__ but had problems with multiple calls to __init__
 
+	_command_table = None # cache for get_command_class(), cleared whenever a new message class is defined
+
+	def __init__(self, name, bases, attrs):
+		super(MessageDispatchMeta, self).__init__(name, bases, attrs)
+		MessageDispatchMeta._command_table = None
+
 	def __call__(self, client, *args, **kwargs):
 		if self is Message: # only Message is special
 			return self.dispatch(client, *args, **kwargs)
@@ -142,22 +154,31 @@ class MessageDispatchMeta(type):
 
 	def dispatch(self, client, command, *params, **kwargs):
 		command = command.upper()
-		for subcls in subclasses(Command):
-			if str(subcls.command).upper() == command or int_equals(subcls.command, command):
-				return subcls(client, params=params, **kwargs)
+		subcls = self.get_command_class(command)
+		if subcls is not None:
+			return subcls(client, params=params, **kwargs)
 		# no matching command, default to generic Message()
 		return super(MessageDispatchMeta, self).__call__(client, command, *params, **kwargs)
 
+	def get_command_class(self, command):
+		"""Returns the Command subclass for the given command, or None"""
+		table = MessageDispatchMeta._command_table
+		if table is None:
+			table = {command_key(subcls.command): subcls for subcls in subclasses(Command)}
+			MessageDispatchMeta._command_table = table
+		return table.get(command_key(command))
+
 
 if sys.version_info.major >= 3:
 	exec("""
 class MessageBase(metaclass=MessageDispatchMeta):
-	pass
+	__slots__ = ()
 """)
 else:
 	exec("""
 class MessageBase(object):
 	__metaclass__ = MessageDispatchMeta
+	__slots__ = ()
 """)
 
 
@@ -176,8 +197,14 @@ class Message(MessageBase):
 		             calculate time since it was receieved, use since_received() instead.
 		extra: A dict provided for the user to store any additional data in for the purpose
 		       of passing around attached to the message, for convenience.
+	Messages are allocated for every line sent or received, so we use __slots__ to keep them small.
+	As a consequence, arbitrary attributes cannot be set on a message - use extra instead.
+	Subclasses should also define __slots__ (usually empty) to keep this benefit.
 	"""
 
+	__slots__ = ('client', 'command', 'params', 'received_at', '_received_at_mono',
+	             'sender', 'user', 'host', 'tags', 'extra')
+
 	def __init__(self, client, command, *params, **kwargs):
 		"""Takes optional kwargs sender, user and host
 		sender, user, host are the args that form the message prefix.
@@ -186,7 +213,9 @@ class Message(MessageBase):
 		"""
 		# due to limitations of python2, we take generic kwargs and pull out our desired args manually
 		self.client = client
-		self.command = command
+		if not isinstance(self, Command):
+			# Command subclasses provide their command as a class attribute
+			self.command = command
 		self.params = params
 		self.received_at = time.time()
 		self._received_at_mono = monotonic()
@@ -199,32 +228,42 @@ class Message(MessageBase):
 			raise TypeError("Unexpected kwargs: {}".format(kwargs))
 
 	def encode(self):
-		parts = [str(self.command)]
-		if self.sender or self.user or self.host:
-			prefix = ':{}'.format(self.sender or '')
-			if self.user:
-				prefix += '!{}'.format(self.user)
-			if self.host:
-				prefix += '@{}'.format(self.host)
-			parts = [prefix] + parts
+		# we build parts in order rather than prepending, and skip straight to the command
+		# in the common case of a client-originated message with no tags or prefix
+		parts = []
 		if self.tags:
-			tags = []
-			for key, value in self.tags.items():
-				if value is True:
-					tags.append(key)
-				else:
-					tags.append("{}={}".format(key, encode_tag_value(value)))
-			tags = ';'.join(tags)
-			parts = ['@{}'.format(tags)] + parts
+			parts.append('@{}'.format(self._encode_tags()))
+		if self.sender or self.user or self.host:
+			parts.append(self._encode_prefix())
+		parts.append(str(self.command))
 		if self.params:
-			params = list(self.params)
-			last_param = params.pop()
-			parts += params + [':{}'.format(last_param)]
+			parts += self.params[:-1]
+			parts.append(':{}'.format(self.params[-1]))
 		return ' '.join(parts)
 
-	def send(self, callback=None, priority=16, block=False):
+	def _encode_tags(self):
+		tags = []
+		for key, value in self.tags.items():
+			if value is True:
+				tags.append(key)
+			else:
+				tags.append("{}={}".format(key, encode_tag_value(value)))
+		return ';'.join(tags)
+
+	def _encode_prefix(self):
+		prefix = ':{}'.format(self.sender or '')
+		if self.user:
+			prefix += '!{}'.format(self.user)
+		if self.host:
+			prefix += '@{}'.format(self.host)
+		return prefix
+
+	def send(self, callback=None, priority=16, block=False, inline=False):
 		"""Send message. If callback given, call when message sent.
 		Callback takes args (client, message)
+		Callbacks are normally run in their own greenlet. If a callback is quick and never blocks,
+		you may pass inline=True (or set callback.inline = True) to have it called directly
+		by the send loop instead.
 		If block=True, waits until message is sent before returning.
 		You cannot pass both callback and block=True (callback is ignored).
 		Note that if you simply need to ensure message Y is sent after message X,
@@ -240,7 +279,8 @@ class Message(MessageBase):
 		if block:
 			event = gevent.event.Event()
 			callback = lambda client, msg: event.set()
-		self.client._send(self, callback, priority)
+			inline = True
+		self.client._send(self, callback, priority, inline)
 		if block:
 			event.wait()
 
@@ -265,12 +305,14 @@ class Message(MessageBase):
 	def since_received(self):
 		"""Use instead of self.received_at to get seconds since message was received.
 		Uses monotonic time instead of wall time, and so is immune to system clock jumps."""
-		return monotonic() - self._received_time_mono
+		return monotonic() - self._received_at_mono
 
 
 class Command(Message):
 	"""Helper subclass that known commands inherit from"""
 
+	__slots__ = ()
+
 	def __init__(self, client, *args, **kwargs):
 		"""We allow params to be set via command-specific args (see from_args)
 		or directly with params kwarg (this is mainly useful when decoding)"""
@@ -296,10 +338,11 @@ class Command(Message):
 
 	@classproperty
 	def command(cls):
-		return cls.__name__.upper()
+		return intern(cls.__name__.upper())
 
 
 class Nick(Command):
+	__slots__ = ()
 	def from_args(self, nickname):
 		return nickname,
 	@property
@@ -307,6 +350,7 @@ class Nick(Command):
 		return self.params[0]
 
 class User(Command):
+	__slots__ = ()
 	def from_args(self, username, realname):
 		# second and third params are unused, send 0
 		return username, '0', '0', realname
@@ -318,6 +362,7 @@ class User(Command):
 		return self.params[3]
 
 class Quit(Command):
+	__slots__ = ()
 	def from_args(self, msg=None):
 		return () if msg is None else (msg,)
 	@property
@@ -325,6 +370,7 @@ class Quit(Command):
 		return self.params[0] if self.params else None
 
 class Join(Command):
+	__slots__ = ()
 	def from_args(self, *channels):
 		"""Channel specs can either be a name like "#foo" or a tuple of (name, key).
 		Like most other functions here, if name does not start with "#" or "&",
@@ -359,6 +405,7 @@ class Join(Command):
 		return dict(zip(names, keys))
 
 class Part(Command):
+	__slots__ = ()
 	def from_args(self, *channels):
 		channels = map(self.client.normalize_channel, channels)
 		return ','.join(channels),
@@ -367,6 +414,7 @@ class Part(Command):
 		return self.params[0].split(',')
 
 class Mode(Command):
+	__slots__ = ()
 	def from_args(self, target, *modes):
 		"""Change mode flags for target (user or chan).
 		Each mode should be in one of these forms:
@@ -437,6 +485,7 @@ class Mode(Command):
 
 class PrivmsgBase(Command):
 	"""Common functionality of Privmsg and Notice"""
+	__slots__ = ()
 
 	def from_args(self, target, msg):
 		"""Target can be user, channel or list of users
@@ -488,12 +537,13 @@ class PrivmsgBase(Command):
 		return cls(client, target, ('ACTION', message))
 
 class Privmsg(PrivmsgBase):
-	pass
+	__slots__ = ()
 
 class Notice(PrivmsgBase):
-	pass
+	__slots__ = ()
 
 class List(Command):
+	__slots__ = ()
 	def from_args(self, *channels):
 		channels = map(self.client.normalize_channel, channels)
 		if not channels: return
@@ -503,6 +553,7 @@ class List(Command):
 		return self.params[0].split(',') if self.params else None
 
 class Kick(Command):
+	__slots__ = ()
 	def from_args(self, channel, nick, msg=None):
 		channel = self.client.normalize_channel(channel)
 		return (channel, nick) if msg is None else (channel, nick, msg)
@@ -517,6 +568,7 @@ class Kick(Command):
 		return self.params[2] if len(self.params) > 2 else None
 
 class Whois(Command):
+	__slots__ = ()
 	def from_args(self, *nicks, **kwargs):
 		"""Takes a server kwarg that I cannot expose explicitly due to python2 limitations"""
 		nicks = ','.join(nicks)
@@ -534,6 +586,7 @@ class Whois(Command):
 		return self.params[0] if len(self.params) > 1 else None
 
 class Ping(Command):
+	__slots__ = ()
 	def from_args(self, payload=None):
 		if payload is None:
 			payload = str(random.randrange(1, 2**31)) # range here is kinda arbitrary, this seems safe
@@ -543,6 +596,7 @@ class Ping(Command):
 		return self.params[0]
 
 class Pong(Command):
+	__slots__ = ()
 	def from_args(self, payload):
 		return payload,
 	@property
@@ -550,6 +604,7 @@ class Pong(Command):
 		return self.params[0]
 
 class ISupport(Command):
+	__slots__ = ()
 	command = replycodes.replies.ISUPPORT
 	def from_args(self, properties):
 		# i'm lazy, and if you want this you're doing something weird
@@ -581,6 +636,46 @@ class ISupport(Command):
 		return result
 
 
+def command_key(command):
+	"""Normalize a command (a string, int or Command subclass) so that two commands are equal
+	under this function exactly when match() would consider them the same command.
+	This lets commands be used as dict keys, eg. to look up handlers by command."""
+	if isinstance(command, type) and issubclass(command, Command):
+		command = command.command
+	if isinstance(command, basestring) and command[:1].isalpha():
+		# Fast path for the common case, which can't be an int.
+		# Received commands are already upper case and interned, so we can return them as is,
+		# and interning the others means lookups by received commands succeed on identity.
+		return command if command.isupper() else intern(command.upper())
+	try:
+		return int(command)
+	except (ValueError, TypeError):
+		return str(command).upper()
+
+
+def peek_command(line):
+	"""Returns the command_key() of the command in an undecoded message line (as str or bytes),
+	without the cost of fully decoding it. Returns None if it can't be determined cheaply,
+	in which case you should decode the message instead."""
+	if isinstance(line, bytes):
+		space, tag_start, prefix_start = b' ', b'@', b':'
+	else:
+		space, tag_start, prefix_start = ' ', '@', ':'
+	allowed = [tag_start, prefix_start] # leading words we skip over, in the order they may appear
+	# the command can be at most the third word, and we don't need to split the rest
+	for word in line.split(space, 3)[:3]:
+		if word[:1] not in allowed:
+			break
+		allowed = allowed[allowed.index(word[:1]) + 1:]
+	else:
+		return None
+	if not word:
+		return None # multiple spaces, just let decode() deal with it
+	if isinstance(word, bytes):
+		word = word.decode('utf-8', 'surrogateescape')
+	return command_key(word)
+
+
 regex_type = type(re.compile(''))
 def match(message, command=None, params=None, **attr_args):
 	"""Return True if message is considered a match according to args:
@@ -622,17 +717,24 @@ def match(message, command=None, params=None, **attr_args):
 		Match a Privmsg sent directly to the client (without being specific to a client):
 			match(message, command=Privmsg, nick=lambda c, v: c.matches_nick(v))
 	"""
-	def match_value(match_spec, value):
-		if match_spec is None:
-			return True
-		if isinstance(match_spec, basestring) or not iterable(match_spec):
-			match_spec = [match_spec]
-		for match_part in match_spec:
-			if isinstance(match_part, regex_type):
-				match_part = match_part.match
-			if isinstance(match_part, basestring):
-				match_value = match_part
-				match_part = lambda v: match_value == v
+	return compile_match(command=command, params=params, **attr_args)(message)
+
+
+def _compile_value_match(match_spec):
+	"""Returns a function (client, value) -> bool implementing a "value must match" spec, as per match()"""
+	if match_spec is None:
+		return lambda client, value: True
+	if isinstance(match_spec, basestring) or not iterable(match_spec):
+		match_spec = [match_spec]
+	match_parts = []
+	for match_part in match_spec:
+		if isinstance(match_part, regex_type):
+			match_part = match_part.match
+		if isinstance(match_part, basestring):
+			match_part = (lambda match_value: lambda v: match_value == v)(match_part)
+		match_parts.append(match_part)
+	def match_value(client, value):
+		for match_part in match_parts:
 			try:
 				try:
 					# does it work with 1 arg?
@@ -640,7 +742,7 @@ def match(message, command=None, params=None, **attr_args):
 						return True
 				except TypeError:
 					# ok, how about 2 args?
-					if match_part(message.client, value):
+					if match_part(client, value):
 						return True
 			except TypeError:
 				# both 1 arg and 2 args raised TypeError - raise the 2nd one as it's most likely a bug
@@ -650,41 +752,38 @@ def match(message, command=None, params=None, **attr_args):
 			except Exception:
 				pass # a failed callable means False
 		return False
+	return match_value
+
+
+def compile_match(command=None, params=None, **attr_args):
+	"""Takes the same args as match(), and returns a function that takes a message
+	and returns whether it matches. This is faster than calling match() repeatedly with the same args,
+	as the args only need to be interpreted once."""
+	checks = []
 
 	if command is not None:
 		if isinstance(command, basestring) or not iterable(command):
-			commands = [command]
-		else:
-			commands = command
-		def gen_command_match(command):
-			def command_match(value):
-				_command = command
-				# is command a Command subclass?
-				if isinstance(_command, type) and issubclass(_command, Command):
-					_command = _command.command
-				# is command an int?
-				if int_equals(_command, value):
-					return True # it's a match
-				# finally, check str
-				_command = str(_command).upper()
-				return _command == value
-			return command_match
-		if not match_value(map(gen_command_match, commands), message.command):
-			return False
+			command = [command]
+		commands = frozenset(map(command_key, command))
+		checks.append(lambda message: command_key(message.command) in commands)
 
 	if params is not None:
 		if callable(params):
-			if not params(message.params):
-				return False
+			checks.append(lambda message: params(message.params))
 		else:
-			if len(params) != len(message.params):
-				return False
-			for match_spec, value in zip(params, message.params):
-				if not match_value(match_spec, value):
+			param_matches = [_compile_value_match(match_spec) for match_spec in params]
+			def params_match(message):
+				if len(param_matches) != len(message.params):
 					return False
+				return all(
+					match_value(message.client, value)
+					for match_value, value in zip(param_matches, message.params)
+				)
+			checks.append(params_match)
 
 	for attr, match_spec in attr_args.items():
-		if not match_value(match_spec, getattr(message, attr)):
-			return False
+		checks.append((lambda attr, match_value:
+			lambda message: match_value(message.client, getattr(message, attr))
+		)(attr, _compile_value_match(match_spec)))
 
-	return True
+	return lambda message: all(check(message) for check in checks)
@@ -2,14 +2,25 @@ import re
 
 from girc.common import dotdict
 
+
+PREFIX_RE = re.compile(r'^\((.*)\)(.*)$')
+
+# Maps CASEMAPPING values to translation tables that, combined with lower(), give the lowercase form of a name
+CASEMAPPINGS = {
+	'ascii': {},
+	'strict-rfc1459': {ord(upper): lower for upper, lower in zip('[]\\', '{}|')},
+	'rfc1459': {ord(upper): lower for upper, lower in zip('[]\\~', '{}|^')},
+}
+
 class ServerProperties(dotdict):
 	"""A dict containing server properties, but with some defaults and pre-processing."""
 
 	defaults = {
 		'CHANTYPES': '#',
 		'PREFIX': '(ov)@+',
-		'CHANMODES': 'biklmnst',
+		# RFC1459's modes, in the 4 comma-separated groups channel_modes expects: list, param-unset, param, noparam
 		'CHANMODES': 'b,k,l,imnst',
+		'CASEMAPPING': 'rfc1459',
 	}
 
 	def __getitem__(self, item):
@@ -20,32 +31,63 @@ class ServerProperties(dotdict):
 	@property
 	def prefixes(self):
 		"""Returns a list of (mode, prefix) in order of most to least power."""
-		match = re.match(r'^\((.*)\)(.*)$', self.PREFIX)
-		if not match:
-			raise ValueError("Invalid format for PREFIX: {!r}".format(self.PREFIX))
-		modes, prefs = match.groups()
-		if len(modes) != len(prefs):
-			raise ValueError("PREFIX modes don't match prefixes: {!r}".format(self.PREFIX))
-		return list(zip(modes, prefs))
+		return list(self._parse_prefix(self.PREFIX))
 
 	@property
 	def channel_modes(self):
 		"""Returns a dict {mode: mode type}. See mode_type() for details."""
+		return dict(self._parse_channel_modes(self.CHANMODES, self.PREFIX))
+
+	# The parsed forms of PREFIX and CHANMODES are cached by their raw value, so they are only parsed again
+	# when those values change. Note these are shared between instances, as the parsing doesn't depend on them.
+	_prefix_cache = {}
+	_channel_modes_cache = {}
+
+	@classmethod
+	def _parse_prefix(cls, prefix):
+		if prefix in cls._prefix_cache:
+			return cls._prefix_cache[prefix]
+		match = PREFIX_RE.match(prefix)
+		if not match:
+			raise ValueError("Invalid format for PREFIX: {!r}".format(prefix))
+		modes, prefs = match.groups()
+		if len(modes) != len(prefs):
+			raise ValueError("PREFIX modes don't match prefixes: {!r}".format(prefix))
+		result = cls._prefix_cache[prefix] = tuple(zip(modes, prefs))
+		return result
 
-		mode_lists = self.CHANMODES.split(',')
+	@classmethod
+	def _parse_channel_modes(cls, chanmodes, prefix):
+		key = chanmodes, prefix
+		if key in cls._channel_modes_cache:
+			return cls._channel_modes_cache[key]
+
+		mode_lists = chanmodes.split(',')
 		if len(mode_lists) != 4:
-			raise ValueError("Invalid format for CHANMODES: {!r}".format(self.CHANMODES))
+			raise ValueError("Invalid format for CHANMODES: {!r}".format(chanmodes))
 		result = {}
 		for mode_list, mode_type in zip(mode_lists, ['list', 'param-unset', 'param', 'noparam']):
 			for mode in mode_list:
 				result[mode] = mode_type
 
 		# prefix modes are list modes
-		for mode, prefix in self.prefixes:
+		for mode, prefix_char in cls._parse_prefix(prefix):
 			result[mode] = 'list'
 
+		cls._channel_modes_cache[key] = result
 		return result
 
+	@property
+	def casefold_table(self):
+		"""Returns a translation table which, applied after lower(), makes names equal iff the server
+		considers them equal. See casefold(). Unknown CASEMAPPINGs are treated as rfc1459."""
+		return CASEMAPPINGS.get(self.CASEMAPPING, CASEMAPPINGS['rfc1459'])
+
+	def casefold(self, name):
+		"""Returns the canonical lowercase form of a nick or channel name, according to CASEMAPPING.
+		If you are doing this a lot, get casefold_table once and apply it yourself."""
+		return name.lower().translate(self.casefold_table)
+
 	def mode_type(self, mode, user_modes=False):
 		"""Returns the "type" of the given mode letter. If user_modes=True, mode is looked up as a user mode,
 		otherwise it's a channel mode. The types are as follows:
@@ -59,4 +101,4 @@ class ServerProperties(dotdict):
 		if user_modes:
 			# there's no CHANMODES equivilent for user modes
 			return
-		return self.channel_modes.get(mode, None)
+		return self._parse_channel_modes(self.CHANMODES, self.PREFIX).get(mode, None)
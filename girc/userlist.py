@@ -1,14 +1,17 @@
 
 from girc import replycodes
+from girc.handler import Handler
 from girc.message import Kick
 
-# TODO case insensitive users
+try:
+	intern
+except NameError:
+	from sys import intern
 
-# TODO track a user's presence in lesser modes so that a sequence like:
-#	+v foo
-#	+o foo
-#	-o foo
-# resolves to foo being in v, instead of '' like currently.
+try:
+	from collections.abc import Set
+except ImportError:
+	from collections import Set
 
 # XXX track more info about a user, maybe over multiple channels
 
@@ -23,7 +26,11 @@ class UserList(object):
 	and its mode letter and prefix char are the empty string.
 	Note that ('voiced', 'v', '+') and ('op', 'o', '@') are mandated by RFC.
 
+	To check whether a user is in the channel at all, use "user in userlist".
+
 	A set of usernames for a given level can be looked up by getitem (eg. userlist['o'] or userlist['@']).
+	This is a read-only view which supports the usual set operations, and reflects later changes to the list.
+	If you need a snapshot (eg. to iterate over while other greenlets run), use set(userlist['o']).
 	You can also look up a level by friendly name as an attribute, eg. userlist.ops
 	This usage will return all users with this prefix OR ABOVE.
 	For example, userlist['o'] will ALWAYS be a subset of userlist['v'],
@@ -35,6 +42,10 @@ class UserList(object):
 	(see individual docstrings).
 	"""
 
+	# there is one of these per joined channel, so we use __slots__ to keep them small
+	__slots__ = ('client', 'channel', 'modes', 'prefix_map', '_prefix_chars', '_rank', '_bits', '_names',
+	             '_casefold_table', '_users')
+
 	KNOWN_NAMES = dict(
 		owners = 'q',
 		admins = 'a',
@@ -49,37 +60,42 @@ class UserList(object):
 		self.client = client
 		self.channel = channel
 		self.parse_prefixes()
-		self.client.handler(self.recv_user_list, command=replycodes.replies.NAMREPLY,
-		                    params=lambda params: len(params) > 2 and params[2] == channel, sync=True)
-		self.client.handler(self.user_join, command='JOIN',
-		                    channels=lambda channels: channel in channels, sync=True)
-		self.client.handler(self.user_leave, command='PART',
-		                    channels=lambda channels: channel in channels, sync=True)
-		self.client.handler(self.user_leave, command='KICK', channel=channel, sync=True)
-		self.client.handler(self.user_leave, command='QUIT', sync=True)
-		self.client.handler(self.user_mode_change, command='MODE', target=channel, sync=True)
-		self.client.handler(self.user_nick_change, command='NICK', sync=True)
+		self.client._user_list_router.register(self)
 
 	def parse_prefixes(self):
-		mode_pairs = self.client.server_properties.prefixes
-
-		# special "users" (nothing) mode
-		mode_pairs.append(('', ''))
-
-		self.modes = [mode for mode, prefix in mode_pairs]
-		self.prefix_map = {prefix: mode for mode, prefix in mode_pairs} # prefix_map maps prefix chars to modes
-		self._user_map = {mode: set() for mode in self.modes} # user_map maps modes to users
+		# The tables describing modes and prefixes are the same for every channel,
+		# so they are built by the router and shared. We must never modify them.
+		(self.modes, self.prefix_map, self._prefix_chars, self._rank, self._bits, self._names,
+		 self._casefold_table) = self.client._user_list_router.get_prefix_tables()
+		# users maps each user to a mask of the modes they hold, where bit N is set if they hold self.modes[N].
+		# Any user present holds the '' mode. This means that:
+		#   the rank of their highest mode is the index of the lowest set bit
+		#   they hold a mode of rank N or better iff mask & ((2 << N) - 1)
+		# All the sets of users we return are derived from it.
+		self._users = {}
 
 	def _resolve_name(self, name):
 		"""Returns mode given mode, prefix or friendly name, or None"""
-		if name in self.modes:
-			return name
-		if name in self.prefix_map:
-			return self.prefix_map[name]
-		if name in self.KNOWN_NAMES:
-			mode = self.KNOWN_NAMES[name]
-			if mode in self.modes:
-				return mode
+		return self._names.get(name)
+
+	def _resolve_rank(self, name):
+		"""Returns rank of mode given mode, prefix or friendly name, or raises KeyError"""
+		mode = self._resolve_name(name)
+		if mode is None:
+			raise KeyError(name)
+		return self._rank[mode]
+
+	def _casefold(self, user):
+		"""All users are stored in casefolded form. We casefold each name exactly once as it comes in,
+		and internal methods expect names that are already casefolded.
+		We also intern the result, so a user present in many channels is only stored once,
+		and its hash is only computed once."""
+		return intern(user.lower().translate(self._casefold_table))
+
+	@staticmethod
+	def _highest_rank(mask):
+		"""Returns rank of the highest mode in a mode mask"""
+		return (mask & -mask).bit_length() - 1
 
 	def __getattr__(self, attr):
 		mode = self._resolve_name(attr)
@@ -88,46 +104,38 @@ class UserList(object):
 		return self[attr]
 
 	def __getitem__(self, item):
-		_item = self._resolve_name(item)
-		if _item is None:
-			raise KeyError(item)
-		item = _item
-		result = set()
-		for mode in self.modes:
-			result.update(self._user_map[mode])
-			if mode == item: break
-		return result
+		return _ModeView(self, self._resolve_rank(item))
+
+	def __contains__(self, user):
+		"""Check if user is in the channel, without building the full set of users"""
+		return self._casefold(user) in self._users
 
 	def only(self, mode):
 		"""Return only users whose highest mode is this mode exactly (friendly names allowed)"""
-		_mode = self._resolve_name(mode)
-		if _mode is None:
+		try:
+			rank = self._resolve_rank(mode)
+		except KeyError:
 			raise ValueError("Unknown mode: {}".format(mode))
-		index = self.modes.index(_mode)
-		higher_mode = self.modes[index - 1] if index > 0 else None
-		result = self[mode]
-		if higher_mode is not None:
-			result -= self[higher_mode]
-		return result
+		at_least = (2 << rank) - 1
+		return {user for user, mask in self._users.items() if mask & at_least == 1 << rank}
 
 	def below(self, mode):
 		"""Return all users that are less priviliged than this mode (friendly names allowed)"""
-		return self.users - self[mode]
+		at_least = (2 << self._resolve_rank(mode)) - 1
+		return {user for user, mask in self._users.items() if not mask & at_least}
 
 	def above(self, mode):
 		"""Return all users that are more priviliged than this mode (friendly names allowed)"""
-		return self[mode] - self.only(mode)
+		greater = (1 << self._resolve_rank(mode)) - 1
+		return {user for user, mask in self._users.items() if mask & greater}
 
 	def get_level(self, user):
 		"""Return the mode of given user, or raise KeyError"""
-		for mode, user_set in self._user_map.items():
-			if user.lower() in user_set:
-				return mode
-		raise KeyError(user)
+		return self.modes[self._highest_rank(self._users[self._casefold(user)])]
 
 	def unregister(self):
-		"""Stop watching for relevant messages, removing the handlers from the client."""
-		# TODO
+		"""Stop watching for relevant messages. The user list will no longer be kept up to date."""
+		self.client._user_list_router.unregister(self)
 
 	# handlers
 
@@ -135,75 +143,214 @@ class UserList(object):
 		"""Generic function for any case where we are told "{prefix}{user}".
 		Note that this is partial information, as only the highest mode is visible
 		(unless multiprefix is enabled)."""
-		modes = set([''])
-		user = user.lower()
-
-		while True:
-			for prefix in self.prefix_map:
-				# look for the prefix that user begins with, not including ''
-				if not user.startswith(prefix) or not prefix:
-					continue
-				modes.add(self.prefix_map[prefix])
-				user = user[1:]
-				break
-			else:
-				# no prefixes found, finish
-				break
-
-		try:
-			old_rank = self.modes.index(self.get_level(user))
-		except KeyError:
-			pass
-		else:
-			rank = min(map(self.modes.index, modes))
-			if old_rank < rank:
-				# user has been downgraded - eliminate all greater modes
-				for mode in self.mode[:rank]:
-					self._user_map[mode].discard(user)
-
-		for mode in modes:
-			self._user_map[mode].add(user)
+		user, mask = self._parse_user_prefix(user)
+		self._users[user] = self._merge_prefix_mask(user, mask)
+
+	def _parse_user_prefix(self, user):
+		"""Takes "{prefix}{user}" and returns (user, mode mask)"""
+		mask = self._bits['']
+		# strip leading prefix chars (there may be several if multiprefix is enabled)
+		name = user.lstrip(self._prefix_chars)
+		for prefix in user[:len(user) - len(name)]:
+			mask |= self._bits[self.prefix_map[prefix]]
+		# note we must casefold after removing prefixes, as some prefix chars (eg. ~) may be affected
+		user = self._casefold(name)
+
+		return user, mask
+
+	def _merge_prefix_mask(self, user, mask):
+		"""Combine the modes we were told about in a prefix with what we already knew about user.
+		The prefix tells us their highest mode, so they no longer hold anything greater.
+		But we keep any lesser modes we knew about, as the prefix doesn't tell us about those."""
+		greater = (mask & -mask) - 1
+		return self._users.get(user, 0) & ~greater | mask
 
 	def recv_user_list(self, client, msg):
 		users = msg.params[3:]
-		# it's unclear if user list is always one space-seperated param or not, let's normalize
-		users = ' '.join(users).split(' ')
+		# it's unclear if user list is always one space-seperated param or not, let's normalize.
+		# It almost always is, in which case we can avoid copying the whole list into a new string.
+		if len(users) == 1:
+			users = users[0].split(' ')
+		else:
+			users = ' '.join(users).split(' ')
+		# we collect the new masks and apply them all at once, which is much cheaper
+		# than one update per user for large channels
+		new_users = {}
 		for user in users:
-			self.recv_user_prefix(user)
+			if not user:
+				continue # eg. trailing space
+			user, mask = self._parse_user_prefix(user)
+			new_users[user] = self._merge_prefix_mask(user, mask)
+		self._users.update(new_users)
 
 	def user_join(self, client, msg):
-		user = msg.sender.lower()
-		self._user_map[''].add(user)
+		user = self._casefold(msg.sender)
+		self._users.setdefault(user, self._bits[''])
 
 	def user_leave(self, client, msg):
 		if isinstance(msg, Kick):
 			user = msg.nick
 		else:
 			user = msg.sender
-		user = user.lower()
-		# remove from all modes
-		for user_set in self._user_map.values():
-			user_set.discard(user)
+		user = self._casefold(user)
+		self._users.pop(user, None)
 
 	def user_mode_change(self, client, msg):
+		# A single MODE may change several modes for the same user (eg. "+ov nick nick"),
+		# so we work out each user's final mask first and then apply them all at once.
+		pending = {}
 		for mode, user, adding in msg.modes:
-			if mode not in self.modes:
+			bit = self._bits.get(mode)
+			if bit is None:
 				continue
 
 			assert user is not None, "MODE message parsed incorrectly: prefix mode {} has no param".format(mode)
-			user = user.lower()
+			user = self._casefold(user)
+			mask = pending.get(user)
+			if mask is None:
+				mask = self._users.get(user, self._bits[''])
 
 			if adding:
-				self._user_map[mode].add(user)
+				pending[user] = mask | bit
 			else:
-				self._user_map[mode].discard(user)
+				pending[user] = mask & ~bit
 				# XXX It's possible that user holds a lesser mode and we don't know (as 353 list only gives
 				#     us their highest mode) - maybe trigger a NAMES or a WHOIS?
+		self._users.update(pending)
+
+	def user_nick_change(self, client, msg):
+		old_nick = self._casefold(msg.sender)
+		new_nick = self._casefold(msg.nickname)
+		mask = self._users.pop(old_nick, None)
+		if mask is not None:
+			self._users[new_nick] = mask
+
+
+class _ModeView(Set):
+	"""The users of a UserList with a given rank or better, as returned by UserList.__getitem__.
+	Membership tests and iteration go straight to the UserList, so expressions like
+	"nick in userlist.ops" don't need to build a set first.
+	Results of set operations (eg. userlist.voiced - userlist.ops) are ordinary sets."""
+	__slots__ = ('user_list', 'at_least')
+
+	def __init__(self, user_list, rank):
+		self.user_list = user_list
+		self.at_least = (2 << rank) - 1
+
+	@classmethod
+	def _from_iterable(cls, iterable):
+		return set(iterable)
+
+	def __contains__(self, user):
+		mask = self.user_list._users.get(self.user_list._casefold(user), 0)
+		return bool(mask & self.at_least)
+
+	def __iter__(self):
+		return (user for user, mask in self.user_list._users.items() if mask & self.at_least)
+
+	def __len__(self):
+		return sum(1 for user in self)
+
+	def __repr__(self):
+		return "<{} {!r}>".format(type(self).__name__, set(self))
+
+
+class UserListRouter(object):
+	"""Watches for messages relevant to user lists on behalf of all UserLists of a client,
+	and passes each one only to the UserLists for the channels it concerns.
+
+	This means the client has a fixed set of user list handlers no matter how many channels
+	are joined, instead of a set of handlers per channel which each need to check every message.
+	Each client has exactly one of these, as client._user_list_router.
+	"""
+
+	def __init__(self, client):
+		self.client = client
+		self.user_lists = {} # maps channel name to UserList
+		self._prefix_tables = None
+		self._prefix_tables_key = None # the server properties that _prefix_tables was built from
+		Handler.register_all(client, self)
+
+	def get_prefix_tables(self):
+		"""Returns (modes, prefix_map, prefix_chars, rank, bits, names, casefold_table) for the client's
+		current server properties, for use by UserList. These are only rebuilt if the relevant server
+		properties have changed, and are shared between all UserLists so must not be modified.
+			modes: Tuple of modes, from most to least powerful, ending in the special '' mode
+			prefix_map: Maps prefix chars to modes
+			prefix_chars: A string of all prefix chars, for use with lstrip()
+			rank: Maps modes to their index in modes
+			bits: Maps modes to their bit in a mode mask (1 << rank)
+			names: Maps any mode, prefix or friendly name to its mode
+			casefold_table: Translation table for casefolding names, see ServerProperties.casefold()
+		"""
+		properties = self.client.server_properties
+		key = properties.PREFIX, properties.CASEMAPPING
+		if key == self._prefix_tables_key:
+			return self._prefix_tables
+
+		# special "users" (nothing) mode
+		mode_pairs = properties.prefixes + [('', '')]
+
+		modes = tuple(mode for mode, prefix in mode_pairs)
+		prefix_map = {prefix: mode for mode, prefix in mode_pairs}
+		rank = {mode: index for index, mode in enumerate(modes)}
+		bits = {mode: 1 << index for mode, index in rank.items()}
+		# We fill names in reverse order of precedence, so that eg. a mode letter always resolves to itself.
+		names = {name: mode for name, mode in UserList.KNOWN_NAMES.items() if mode in rank}
+		names.update(prefix_map)
+		names.update((mode, mode) for mode in modes)
+
+		prefix_chars = ''.join(prefix for mode, prefix in mode_pairs)
+		self._prefix_tables = modes, prefix_map, prefix_chars, rank, bits, names, properties.casefold_table
+		self._prefix_tables_key = key
+		return self._prefix_tables
+
+	def register(self, user_list):
+		"""Start routing messages to user_list. Replaces any existing UserList for the same channel."""
+		self.user_lists[user_list.channel] = user_list
+
+	def unregister(self, user_list):
+		"""Stop routing messages to user_list. Does nothing if it was already unregistered or replaced."""
+		if self.user_lists.get(user_list.channel) is user_list:
+			del self.user_lists[user_list.channel]
+
+	def _route(self, client, msg, callback, channels=None):
+		"""Call callback(user_list, client, msg) for the UserList of each named channel,
+		or for all UserLists if channels is None."""
+		if channels is None:
+			user_lists = list(self.user_lists.values())
+		else:
+			user_lists = filter(None, map(self.user_lists.get, channels))
+		for user_list in user_lists:
+			try:
+				callback(user_list, client, msg)
+			except Exception:
+				client.logger.exception("User list for {} failed to handle message {}".format(user_list.channel, msg))
+
+	@Handler(command=replycodes.replies.NAMREPLY, params=lambda params: len(params) > 2, sync=True)
+	def recv_user_list(self, client, msg):
+		self._route(client, msg, UserList.recv_user_list, [msg.params[2]])
+
+	@Handler(command='JOIN', sync=True)
+	def user_join(self, client, msg):
+		self._route(client, msg, UserList.user_join, msg.channels)
+
+	@Handler(command='PART', sync=True)
+	def user_part(self, client, msg):
+		self._route(client, msg, UserList.user_leave, msg.channels)
+
+	@Handler(command='KICK', sync=True)
+	def user_kick(self, client, msg):
+		self._route(client, msg, UserList.user_leave, [msg.channel])
+
+	@Handler(command='QUIT', sync=True)
+	def user_quit(self, client, msg):
+		self._route(client, msg, UserList.user_leave)
+
+	@Handler(command='MODE', sync=True)
+	def user_mode_change(self, client, msg):
+		self._route(client, msg, UserList.user_mode_change, [msg.target])
 
+	@Handler(command='NICK', sync=True)
 	def user_nick_change(self, client, msg):
-		old_nick = msg.sender.lower()
-		new_nick = msg.nickname.lower()
-		for user_set in self._user_map.values():
-			if old_nick in user_set:
-				user_set.remove(old_nick)
-				user_set.add(new_nick)
+		self._route(client, msg, UserList.user_nick_change)
@@ -0,0 +1,152 @@
+
+"""Tests for Client against a fake server running in a real OS thread,
+so that its sends aren't scheduled by (and can't yield to) the client's gevent hub.
+Run with: python -m unittest discover tests
+"""
+
+import socket
+import threading
+import time
+import unittest
+
+import gevent
+
+from girc import Client, replycodes
+
+
+class FakeServer(object):
+	"""Accepts one client, completes registration, then calls flood(server) from the server thread.
+	Every line received from the client is passed to on_line(server, line)."""
+
+	def __init__(self, flood, on_line=lambda server, line: None):
+		self.flood = flood
+		self.on_line = on_line
+		self.registered = threading.Event()
+		self.listener = socket.socket()
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(1)
+		self.port = self.listener.getsockname()[1]
+		self.conn = None
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _run(self):
+		try:
+			self.conn, addr = self.listener.accept()
+			reader = threading.Thread(target=self._read)
+			reader.daemon = True
+			reader.start()
+			self.registered.wait()
+			self.send(':srv 001 me :Welcome')
+			self.flood(self)
+		except (socket.error, ValueError):
+			pass # the test finished and closed the connection under us
+
+	def _read(self):
+		try:
+			for line in self.conn.makefile('rb'):
+				line = line.decode('utf-8').rstrip('\r\n')
+				if line.startswith('USER '):
+					self.registered.set()
+				self.on_line(self, line)
+		except (socket.error, ValueError):
+			pass # the test finished and closed the connection under us
+
+	def send(self, *lines):
+		self.conn.sendall(b''.join(line.encode('utf-8') + b'\r\n' for line in lines))
+
+	def close(self):
+		for sock in (self.conn, self.listener):
+			if sock is not None:
+				sock.close()
+
+
+def wait_until(condition, timeout):
+	"""Wait cooperatively until condition() is true. Returns whether it became true in time."""
+	deadline = time.time() + timeout
+	while not condition():
+		if time.time() > deadline:
+			return False
+		gevent.sleep(0.01)
+	return True
+
+
+class FloodTests(unittest.TestCase):
+
+	FLOOD_LINES = 50000
+
+	def run_flood(self, ping_at, handler_kwargs, slow_handler=None):
+		"""Floods the client with PRIVMSGs, with a PING at line ping_at.
+		If given, slow_handler(msg) is called for each PRIVMSG after it is counted.
+		Returns (number of PRIVMSGs the client had processed when the PONG arrived or None, total processed)."""
+		processed = [0]
+		pong_at = []
+
+		def flood(server):
+			lines = [':a!u@h PRIVMSG #c :line {}'.format(i) for i in range(self.FLOOD_LINES)]
+			lines.insert(ping_at, 'PING :flood')
+			server.send(*lines)
+
+		def on_line(server, line):
+			if line == 'PONG :flood':
+				pong_at.append(processed[0])
+
+		server = FakeServer(flood, on_line)
+		self.addCleanup(server.close)
+		client = Client('127.0.0.1', 'me', port=server.port)
+		self.addCleanup(client.stop)
+
+		@client.handler(command='PRIVMSG', **handler_kwargs)
+		def count(client, msg):
+			processed[0] += 1
+			if slow_handler:
+				slow_handler(msg)
+
+		client.start()
+		self.assertTrue(wait_until(lambda: pong_at or processed[0] == self.FLOOD_LINES, 60))
+		return (pong_at[0] if pong_at else None), processed[0]
+
+	def test_ping_answered_during_flood(self):
+		# A sync handler with no ordering constraints is run inline by the recv loop,
+		# which must still let the PONG out while the flood is ongoing.
+		pong_at, processed = self.run_flood(1000, dict(sync=True))
+		self.assertIsNotNone(pong_at, "no PONG before the flood was fully processed")
+		self.assertLess(pong_at, self.FLOOD_LINES)
+
+	def test_ping_answered_during_slow_handler(self):
+		# A slow handler which blocks (cooperatively) must not hold up the PONG either.
+		self.FLOOD_LINES = 10
+		def slow(msg):
+			gevent.sleep(0.2)
+		pong_at, processed = self.run_flood(1, dict(sync=True), slow)
+		self.assertIsNotNone(pong_at, "no PONG before the flood was fully processed")
+		self.assertLess(pong_at, self.FLOOD_LINES)
+
+
+class ProcessTests(unittest.TestCase):
+
+	def test_repeated_spaces_not_skipped(self):
+		# peek_command() can't find the command in these cheaply, so they must be decoded rather than skipped
+		client = Client('127.0.0.1', 'me')
+		seen = []
+
+		@client.handler(command='PRIVMSG', sync=True)
+		def privmsg(client, msg):
+			seen.append(msg.command)
+
+		@client.handler(command=replycodes.replies.WELCOME, sync=True)
+		def welcome(client, msg):
+			seen.append(msg.command)
+
+		for line in (b':a!b@c  PRIVMSG #c :hi', b':srv  001 me :hi', b'@a=1  PRIVMSG #c :hi'):
+			client._process(line)
+		self.assertEqual(seen, ['PRIVMSG', '001', 'PRIVMSG'])
+
+		# lines we know nobody wants are still skipped
+		client._process(b':a!b@c NOTICE #c :hi')
+		self.assertEqual(len(seen), 3)
+
+
+if __name__ == '__main__':
+	unittest.main()
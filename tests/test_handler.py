@@ -0,0 +1,33 @@
+
+"""Tests for Handler.
+Run with: python -m unittest discover tests
+"""
+
+import unittest
+
+from girc.handler import Handler
+
+
+class OrderingArgsTests(unittest.TestCase):
+
+	def callback(self, client, msg):
+		pass
+
+	def test_after_single_string(self):
+		handler = Handler(callback=self.callback, after='sync')
+		self.assertEqual(handler.after, {'sync'})
+
+	def test_before_single_handler(self):
+		other = Handler(callback=self.callback)
+		handler = Handler(callback=self.callback, before=other, sync=True)
+		self.assertEqual(handler.before, {other, 'sync'})
+
+	def test_iterables(self):
+		other = Handler(callback=self.callback)
+		handler = Handler(callback=self.callback, before=[other, 'sync'], after=('a', 'b'))
+		self.assertEqual(handler.before, {other, 'sync'})
+		self.assertEqual(handler.after, {'a', 'b'})
+
+
+if __name__ == '__main__':
+	unittest.main()